@@ -5,112 +5,193 @@ Compact "pair-RLE" encoder for MMBasic with no files on disk.
 
 Format emitted into DATA:
 - First: palette size P, then P triples of r,g,b
-- Then for each row y = 0..H-1:
-    DATA nPairs, len1, col1, len2, col2, ..., lenN, colN
-- After last row, a terminator DATA of just -1
+- Then one base64 byte stream, split over DATA "..." strings of 240 chars,
+  holding varints (7 bits per byte, low group first, high bit = more follow).
+  For each run of identical rows starting at y:
+    2*nPairs + (rowCount>1), [rowCount,] len1, col1, len2, col2, ..., lenN, colN
+  (rowCount is only present when rowCount >= 2)
 
 Decoder emitted in BASIC:
 - Builds pal%(i) = RGB(r,g,b)
-- For y from 0..H-1:
-    READ n : IF n=-1 THEN EXIT DO
+- NB%() pulls the next byte out of the base64 strings, RV%() the next varint
+- While y < H:
+    n=RV%() : rh=1 : IF n AND 1 THEN rh=RV%()
     x=0
-    FOR k=1 TO n
-       READ l,c : LINE x,y,x+l-1,y, , pal%(c) : x=x+l
+    FOR k=1 TO n>>1
+       l=RV%() : c=RV%() : LINE (rh=1) or BOX x,y,l,rh (rh>1) in pal%(c) : x=x+l
     NEXT
-This avoids storing xStart and y for every run, cutting DATA roughly in half.
+    y=y+rh
+This avoids storing xStart and y for every run, draws flat areas that repeat
+down the image as one BOX per run, and keeps most values to a single byte.
 """
 
-from PIL import Image
+from PIL import Image, features
+import PIL
+import numpy as np
 import argparse
+import base64
+import sys
+from itertools import chain
 
-def quantize_image(img, n_colors, dither):
-    if n_colors <= 0: return img.convert("RGB")
+def is_pillow_simd():
+    # Pillow-SIMD releases carry a ".postN" suffix on the upstream version
+    return ".post" in PIL.__version__
+
+def as_rgb(img):
+    # convert() always copies, even RGB -> RGB
+    return img if img.mode == "RGB" else img.convert("RGB")
+
+QUANTIZE_METHODS = {"mediancut": Image.MEDIANCUT, "fastoctree": Image.FASTOCTREE, "libimagequant": Image.LIBIMAGEQUANT}
+
+def quantize_image(img, n_colors, dither, method=Image.MEDIANCUT):
+    if n_colors <= 0: return as_rgb(img)
     dither_flag = Image.FLOYDSTEINBERG if dither else Image.NONE
-    q = img.convert("RGB").quantize(colors=n_colors, method=Image.MEDIANCUT, dither=dither_flag)
-    return q.convert("RGB")
+    # Keep the "P" image: its pixels are already palette indices
+    return as_rgb(img).quantize(colors=n_colors, method=method, dither=dither_flag)
 
-def letterbox(img, tw, th, bg=(0,0,0)):
+RESAMPLE = {"bilinear": Image.BILINEAR, "bicubic": Image.BICUBIC, "lanczos": Image.LANCZOS}
+
+def letterbox(img, tw, th, bg=(0,0,0), resample=Image.LANCZOS):
     sw, sh = img.size
     scale = min(tw/sw, th/sh)
     nw, nh = max(1, int(round(sw*scale))), max(1, int(round(sh*scale)))
+    # reducing_gap: box-reduce in C first, leaving >= 3x the target for the real filter
+    r = img.resize((nw, nh), resample, reducing_gap=3.0)
+    if (nw, nh) == (tw, th): return r  # aspect already matches: no bars to fill
     c = Image.new("RGB", (tw, th), bg)
-    c.paste(img.resize((nw, nh), Image.LANCZOS), ((tw-nw)//2, (th-nh)//2))
+    c.paste(r, ((tw-nw)//2, (th-nh)//2))
     return c
 
-def solid_resize(img, tw, th):
-    return img.resize((tw, th), Image.LANCZOS)
+def solid_resize(img, tw, th, resample=Image.LANCZOS):
+    return img.resize((tw, th), resample, reducing_gap=3.0)
+
+def pack_rgb(a):
+    """Pack an (H,W,3) uint8 array into (H,W) uint32 0x00RRGGBB."""
+    # Lay the bytes out as B,G,R,0 and reinterpret each pixel as one little-endian word:
+    # byte copies only, no per-channel uint32 temporaries or shifts
+    h,w,_ = a.shape
+    b = np.empty((h, w, 4), np.uint8)
+    b[...,0] = a[...,2]; b[...,1] = a[...,1]; b[...,2] = a[...,0]; b[...,3] = 0
+    return b.view("<u4")[...,0]
+
+def unpack_rgb(v):
+    return ((v >> 16) & 0xFF, (v >> 8) & 0xFF, v & 0xFF)
 
 def build_palette(img):
-    pal = []
-    idx = {}
-    px = img.load()
-    w,h = img.size
-    for y in range(h):
-        for x in range(w):
-            c = px[x,y][:3]
-            if c not in idx:
-                idx[c] = len(pal); pal.append(c)
-    return pal, idx
-
-def row_pairs(img, idxmap):
+    """Return (pal, inv): pal is [(r,g,b), ...], inv is the (H,W) palette index plane."""
+    if img.mode == "P":
+        # Quantized image: the pixels already are the index plane
+        inv = np.asarray(img)
+        pal_flat = img.getpalette("RGB")[:3*(int(inv.max())+1)]
+        return list(zip(pal_flat[0::3], pal_flat[1::3], pal_flat[2::3])), inv
+    packed = pack_rgb(np.asarray(as_rgb(img)))
+    uniq, inv = np.unique(packed.ravel(), return_inverse=True)
+    pal = [unpack_rgb(v) for v in uniq.tolist()]
+    return pal, inv.reshape(packed.shape)
+
+def row_pairs(inv):
     """Return list of rows; each row is [(len, colorIdx), ...] starting at x=0."""
-    rows = []
-    px = img.load()
-    w,h = img.size
-    for y in range(h):
-        x = 0
-        pairs = []
-        while x < w:
-            c = px[x,y][:3]
-            ci = idxmap[c]
-            x0 = x; x += 1
-            while x < w and px[x,y][:3] == c: x += 1
-            pairs.append((x - x0, ci))
-        rows.append(pairs)
+    h,w = inv.shape
+    rows = [None]*h
+    for y,r in enumerate(inv):
+        if r[0] == r[-1] and (r == r[0]).all():
+            rows[y] = [(w, int(r[0]))]; continue
+        # Run boundaries are wherever a pixel differs from its left neighbour
+        changes = np.flatnonzero(r[1:] != r[:-1])
+        ends = np.append(changes, w-1)
+        starts = np.append(0, changes+1)
+        rows[y] = list(zip((ends - starts + 1).tolist(), r[ends].tolist()))
     return rows
 
-def chunked(seq, n):
-    for i in range(0, len(seq), n):
-        yield seq[i:i+n]
+def row_spans(inv):
+    """Return [(rowCount, pairs), ...]; consecutive identical rows are scanned once and share an entry."""
+    h = inv.shape[0]
+    rep = np.zeros(h, bool)
+    rep[1:] = (inv[1:] == inv[:-1]).all(axis=1)  # row y repeats row y-1
+    starts = np.flatnonzero(~rep)
+    counts = np.diff(np.append(starts, h)).tolist()
+    return list(zip(counts, row_pairs(inv[starts])))
 
-def emit_bas(img, pal, rows, title, author):
+def pack_varints(vals):
+    """LEB128-encode non-negative ints: 7 bits per byte, low group first, high bit = more follow."""
+    if max(vals) < 128: return bytes(vals)
+    out = bytearray()
+    for v in vals:
+        while v > 127:
+            out.append((v & 127) | 128); v >>= 7
+        out.append(v)
+    return out
+
+def write_b64(f, data):
+    s = base64.b64encode(data).decode("ascii").rstrip("=")
+    for i in range(0, len(s), 240): f.write('DATA "' + s[i:i+240] + '"\n')
+
+def emit_bas(f, img, pal, spans, title, author):
+    """Write the program to text file f; DATA lines are streamed, not joined in memory."""
     w,h = img.size
     L = []
     L.append(f"REM {title}" if title else "REM Image via Pair-RLE")
     if author: L.append(f"REM Author: {author}")
-    L += ["OPTION EXPLICIT","CLS RGB(0,0,0)","SUB DrawImage()",
+    L += ["OPTION EXPLICIT","CLS RGB(0,0,0)",
+          "DIM d64$ = \"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/\"",
+          "DIM ds$, da%, dn%",
+          "DIM dp% = 1",
+          "SUB DrawImage()",
           f"  CONST W={w}, H={h}",
           "  DIM pal%(255)",
-          "  LOCAL i, r, g, b, y, x, n, k, l, c",
+          "  LOCAL i, r, g, b, y, x, n, k, l, c, rh",
           "  READ i : IF i <> " + str(len(pal)) + " THEN PRINT \"Bad palette\" : END",
           "  FOR i=0 TO " + str(len(pal)-1),
           "    READ r,g,b : pal%(i)=RGB(r,g,b)",
           "  NEXT",
-          "  FOR y=0 TO H-1",
-          "    READ n : IF n=-1 THEN EXIT FOR",
-          "    x=0",
+          "  y=0",
+          "  DO WHILE y<H",
+          "    n=RV%() : rh=1",
+          "    IF n AND 1 THEN rh=RV%()",
+          "    n=n>>1 : x=0",
           "    FOR k=1 TO n",
-          "      READ l,c",
-          "      LINE x,y,x+l-1,y, , pal%(c)",
+          "      l=RV%() : c=RV%()",
+          "      IF rh=1 THEN LINE x,y,x+l-1,y, , pal%(c) ELSE BOX x,y,l,rh,1,pal%(c),pal%(c)",
           "      x=x+l",
           "    NEXT k",
-          "  NEXT y",
+          "    y=y+rh",
+          "  LOOP",
           "END SUB",
+          "FUNCTION NB%()",
+          "  DO WHILE dn%<8",
+          "    IF dp%>LEN(ds$) THEN READ ds$ : dp%=1",
+          "    da%=((da%<<6) OR (INSTR(d64$,MID$(ds$,dp%,1))-1)) AND &HFFFF",
+          "    dp%=dp%+1 : dn%=dn%+6",
+          "  LOOP",
+          "  dn%=dn%-8",
+          "  NB%=(da%>>dn%) AND 255",
+          "END FUNCTION",
+          "FUNCTION RV%()",
+          "  LOCAL v%, sh%, by%",
+          "  DO",
+          "    by%=NB%() : v%=v% OR ((by% AND 127)<<sh%) : sh%=sh%+7",
+          "  LOOP WHILE by%>127",
+          "  RV%=v%",
+          "END FUNCTION",
           "DrawImage"]
+    f.write("\n".join(L) + "\n")
     # Palette
-    L.append(f"DATA {len(pal)}")
-    pvals = []
-    for r,g,b in pal: pvals += [r,g,b]
-    for ch in chunked(pvals, 24): L.append("DATA " + ",".join(map(str, ch)))
-    # Rows
-    for pairs in rows:
-        flat = [len(pairs)]
-        for l,c in pairs: flat += [l,c]
-        for ch in chunked(flat, 32):
-            L.append("DATA " + ",".join(map(str, ch)))
-    # Terminator
-    L.append("DATA -1")
-    return "\n".join(L) + "\n"
+    f.write("DATA " + str(len(pal)) + "\n")
+    pal_strs = ["%d,%d,%d" % c for c in pal]
+    for i in range(0, len(pal_strs), 8): f.write("DATA " + ",".join(pal_strs[i:i+8]) + "\n")
+    # Rows: varint stream of [2*nPairs + (rowCount>1), rowCount if >1, len1, col1, ...],
+    # base64'd into string DATA. 180 bytes -> 240 chars with no padding, so chunks
+    # can be flushed as the stream grows and the decoder reads straight across them.
+    blob = bytearray()
+    for rh,pairs in spans:
+        flat = [2*len(pairs) + (rh > 1)]
+        if rh > 1: flat.append(rh)
+        flat.extend(chain.from_iterable(pairs))
+        blob += pack_varints(flat)
+        if len(blob) >= 180*64:
+            n = len(blob) - len(blob) % 180
+            write_b64(f, blob[:n]); del blob[:n]
+    write_b64(f, blob)
 
 def main():
     ap = argparse.ArgumentParser()
@@ -120,24 +201,38 @@ def main():
     ap.add_argument("--height", type=int, default=0)
     ap.add_argument("--keep-aspect", type=int, default=1)
     ap.add_argument("--bg", type=str, default="0,0,0")
+    ap.add_argument("--resample", choices=sorted(RESAMPLE), default="lanczos")
     ap.add_argument("--quantize", type=int, default=48)  # slightly lower default to save more space
+    ap.add_argument("--quantize-method", choices=list(QUANTIZE_METHODS), default=None,
+                    help="default: fastoctree for --quantize <= 64, else mediancut")
     ap.add_argument("--dither", type=int, default=1)
     ap.add_argument("--title", type=str, default="Image Pair-RLE")
     ap.add_argument("--author", type=str, default="")
     args = ap.parse_args()
+    qm = args.quantize_method or ("fastoctree" if args.quantize <= 64 else "mediancut")
+    if qm == "libimagequant" and not features.check_feature("libimagequant"):
+        ap.error("--quantize-method libimagequant: this Pillow build lacks libimagequant")
 
-    img = Image.open(args.input_image).convert("RGB")
+    img = Image.open(args.input_image)
     sw,sh = img.size
     tw = args.width if args.width>0 else sw
     th = args.height if args.height>0 else sh
+    # JPEG only: let the decoder downscale by 1/2..1/8 while staying >= target
+    img.draft("RGB", (tw, th))
+    img.load()  # decode once, up front
+    img = as_rgb(img)
+    sw,sh = img.size
     bg = tuple(map(int, args.bg.split(",")))
-    if (tw,th)!=(sw,sh): img = letterbox(img, tw, th, bg) if args.keep_aspect else solid_resize(img, tw, th)
-    img = quantize_image(img, args.quantize, bool(args.dither))
-    pal, idx = build_palette(img)
-    rows = row_pairs(img, idx)
-    out = emit_bas(img, pal, rows, args.title, args.author)
-    from pathlib import Path
-    Path(args.output_bas).write_text(out, encoding="utf-8")
+    rs = RESAMPLE[args.resample]
+    if (tw,th)!=(sw,sh):
+        if not is_pillow_simd():
+            print("Note: plain Pillow", PIL.__version__, "detected; pillow-simd resizes several times faster", file=sys.stderr)
+        img = letterbox(img, tw, th, bg, rs) if args.keep_aspect else solid_resize(img, tw, th, rs)
+    img = quantize_image(img, args.quantize, bool(args.dither), QUANTIZE_METHODS[qm])
+    pal, inv = build_palette(img)
+    spans = row_spans(inv)
+    with open(args.output_bas, "w", encoding="utf-8", buffering=1<<20) as f:
+        emit_bas(f, img, pal, spans, args.title, args.author)
     print("Wrote", args.output_bas, "size", img.size, "palette", len(pal))
 
 if __name__ == "__main__":
@@ -0,0 +1,106 @@
+"""Round-trip emit_bas output through a Python copy of the emitted BASIC decoder.
+
+decode() mirrors NB%() / RV%() and the DrawImage row loop line for line, so a
+change to the encoder that the on-device decoder can't read fails here.
+"""
+
+import io
+import re
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import image_to_mmbasic as m
+
+B64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+def data_items(text):
+    for line in text.splitlines():
+        if line.startswith("DATA "):
+            yield from re.findall(r'"[^"]*"|[^,]+', line[5:])
+
+def decode(text):
+    """Return (pal, inv, n_strings) decoded from an emitted program."""
+    W = int(re.search(r"W=(\d+)", text).group(1))
+    H = int(re.search(r"H=(\d+)", text).group(1))
+    it = data_items(text)
+    P = int(next(it))
+    pal = [tuple(int(next(it)) for _ in range(3)) for _ in range(P)]
+    st = {"s": "", "p": 1, "a": 0, "n": 0, "reads": 0}
+
+    def NB():
+        while st["n"] < 8:
+            if st["p"] > len(st["s"]):
+                tok = next(it)
+                assert tok[0] == tok[-1] == '"' and len(tok) - 2 <= 240
+                st["s"] = tok[1:-1]; st["p"] = 1; st["reads"] += 1
+            st["a"] = ((st["a"] << 6) | B64.index(st["s"][st["p"]-1])) & 0xFFFF
+            st["p"] += 1; st["n"] += 6
+        st["n"] -= 8
+        return (st["a"] >> st["n"]) & 255
+
+    def RV():
+        v = sh = 0
+        while True:
+            b = NB(); v |= (b & 127) << sh; sh += 7
+            if b <= 127: return v
+
+    inv = np.full((H, W), -1, np.int64)
+    y = 0
+    while y < H:
+        n = RV(); rh = 1
+        if n & 1: rh = RV()
+        x = 0
+        for _ in range(n >> 1):
+            l = RV(); c = RV()
+            inv[y:y+rh, x:x+l] = c; x += l
+        assert x == W
+        y += rh
+    assert y == H
+    assert list(it) == []  # no DATA left over
+    return pal, inv, st["reads"]
+
+def roundtrip(img):
+    pal, inv = m.build_palette(img)
+    f = io.StringIO()
+    m.emit_bas(f, img, pal, m.row_spans(inv), "t", "")
+    dpal, dinv, reads = decode(f.getvalue())
+    assert dpal == [tuple(c) for c in pal]
+    assert (dinv == inv).all()
+    return reads
+
+def noise(w, h, seed=0):
+    a = np.random.default_rng(seed).integers(0, 256, (h, w, 3), dtype=np.uint8)
+    return Image.fromarray(a)
+
+def test_noise_crosses_flush_threshold():
+    # ~60k single-pixel runs: stream far exceeds 180*64 bytes, so emit_bas flushes mid-stream
+    assert roundtrip(noise(300, 200)) > 64
+
+def test_stream_crosses_one_chunk_boundary():
+    # A few hundred bytes: spans two or three 240-char DATA strings
+    assert 2 <= roundtrip(noise(20, 8)) <= 3
+
+def test_flat_with_repeated_rows_and_wide_runs():
+    a = np.zeros((50, 300, 3), np.uint8)
+    a[10:30, 150:] = (255, 0, 0)  # runs of 150 need two-byte varints
+    a[40] = (0, 0, 255)
+    assert roundtrip(Image.fromarray(a)) == 1
+
+@pytest.mark.parametrize("img", [
+    Image.new("RGB", (64, 48), (1, 2, 3)),
+    Image.new("RGB", (1, 1), (9, 9, 9)),
+    noise(33, 17).convert("L"),
+    noise(33, 17).convert("RGBA"),
+], ids=["solid", "1x1", "greyscale", "rgba"])
+def test_small_and_odd_modes(img):
+    roundtrip(img)
+
+def test_quantized_palette_image():
+    img = m.quantize_image(noise(120, 90), 16, True, Image.FASTOCTREE)
+    assert img.mode == "P"
+    roundtrip(img)